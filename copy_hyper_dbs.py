@@ -9,35 +9,74 @@
 #
 # -----------------------------------------------------------------------------
 
-""" Tool to adjust vertex order of polygons in a hyper file
+""" Tool to add WKT polygons to a Tableau custom geocoding hyper file
 
-This script enables a customer to adjust the vertex order of all polygons in a hyper file
+This script enables a customer to add polygons to a custom geographic role in a hyper file
 It provides two commands, list and run
  - List: enumerates all tables specifying which columns are of 'GEOGRAPHY' type
- - Run: adjusts the vertex order of all polygons in a .hyper file, writing the output to a new .hyper file
-   Run has two modes: auto and invert:
-    - auto mode automatically adjusts the vertex order according to the interior-left definition of
-      polygons assuming the data comes from a data source that uses a flat-earth topology
-    - invert mode inverts the vertex order for all polygons
-   All other (non-geography) columns are just copied as is to the output file
-   Tables without geography columns are also copied to the output file
+ - Run: copies a .hyper file to a new .hyper file and adds a Geometry column with the WKT polygons
+   from a .csv file to the role's LocalData table, matching rows on Latitude and Longitude
+   All other columns and tables are just copied as is to the output file
 """
 
 import argparse
+import concurrent.futures
 import shutil
-import subprocess
 import sys
 import csv
 import os
 
-from enum import Enum
 from pathlib import Path
 
-from tableauhyperapi import HyperProcess, Telemetry, Connection, SqlType, TableName, Name, escape_string_literal
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from tableauhyperapi import HyperProcess, Telemetry, Connection, SqlType, TableName, Name, \
+    TableDefinition, Persistence, Inserter
 
 #Set this.  Otherwise, the default size limit is too small and will exit for modest sized polygon WKT.
 csv.field_size_limit(100000000)
 
+#Linux ioctl request that clones a whole file on copy-on-write filesystems (btrfs, XFS).
+FICLONE = 0x40049409
+
+
+def copy_file(src, dst):
+    """ Copies the contents of src to dst
+    On Linux the file is first cloned with the FICLONE ioctl, which is a constant-time reflink
+    on copy-on-write filesystems. Otherwise the copy is done in the kernel with os.copy_file_range.
+    Falls back to shutil.copyfile elsewhere.
+    :param src: Path of the file to copy
+    :param dst: Path of the file to create
+    """
+    if not hasattr(os, "copy_file_range"):
+        shutil.copyfile(src, dst)
+        return
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return
+            except OSError:
+                # not supported by this filesystem, or src and dst are on different filesystems
+                pass
+        remaining = os.fstat(fsrc.fileno()).st_size
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        except OSError:
+            # e.g. cross-device copy on older kernels; copy the rest in user space
+            shutil.copyfileobj(fsrc, fdst)
+        else:
+            if remaining > 0:
+                shutil.copyfileobj(fsrc, fdst)
+
+
 class ListTables:
     """ Command to list tables with spatial columns in a .hyper file"""
 
@@ -50,6 +89,8 @@ class ListTables:
         """
         arg_parser.add_argument("-i", "--input_file", type=Path, metavar="<input.hyper>",
                                 required=True, help="Input .hyper file")
+        arg_parser.add_argument("--with-counts", dest="with_counts", action="store_true",
+                                help="Also count the rows of every table (scans all tables)")
 
     def run(self, args):
         """ Runs the command
@@ -65,53 +106,73 @@ class ListTables:
             with Connection(endpoint=hyper.endpoint,
                             database=input_file) as connection:
                 catalog = connection.catalog
-                # Iterates over all schemas in the input file
-                for schema_name in catalog.get_schema_names():
-                    # Iterates over all tables in the current schema
-                    for table in catalog.get_table_names(schema=schema_name):
-                        table_definition = catalog.get_table_definition(name=table)
-                        rows_in_table = connection.execute_scalar_query(query=f"SELECT COUNT(*) FROM {table}")
-                        spatial_columns = [c.name for c in table_definition.columns if c.type == SqlType.geography()]
-                        if spatial_columns:
-                            print(f"Table {table} with {rows_in_table} rows has"
-                                  f" {len(spatial_columns)} spatial columns: {spatial_columns}")
-                        else:
-                            print(f"Table {table} with {rows_in_table} rows has no spatial columns")
-
-
-class AdjustVertexOrderMode(Enum):
-    """ Modes for adjusting vertex order """
-    AUTO = "auto"
-    INVERT = "invert"
+                # Collects the tables of all schemas in the input file
+                tables = [table for schema_name in catalog.get_schema_names()
+                          for table in catalog.get_table_names(schema=schema_name)]
+                row_counts = self._count_rows(connection, tables) if args.with_counts else None
+                for i, table in enumerate(tables):
+                    table_definition = catalog.get_table_definition(name=table)
+                    spatial_columns = [c.name for c in table_definition.columns if c.type == SqlType.geography()]
+                    table_text = f"Table {table} with {row_counts[i]} rows" if row_counts else f"Table {table}"
+                    if spatial_columns:
+                        print(f"{table_text} has {len(spatial_columns)} spatial columns: {spatial_columns}")
+                    else:
+                        print(f"{table_text} has no spatial columns")
+
+    @staticmethod
+    def _count_rows(connection, tables):
+        """ Returns the row counts of the given tables, in the same order, using a single query
+        :param connection: Connection to the .hyper file
+        :param tables: List of TableName
+        """
+        if not tables:
+            return []
+        query = " UNION ALL ".join(f"SELECT {i}, COUNT(*) FROM {table}" for i, table in enumerate(tables))
+        counts = dict(connection.execute_list_query(query=query))
+        return [counts[i] for i in range(len(tables))]
 
 
 class CsvQueryClass:
-    """ Opens CSV and has a method to query out a row of data based on an input """
+    """ Opens CSV and streams its Latitude, Longitude and WKT values """
 
     def __init__(self):
+        self.path = None
         self.fieldnames = []
-        self.rows = []
 
     def open_csv(self, path):
-        #Open a specified .csv, and read the rows. Later we'll look thru the rows and use the WKT we find to insert into the local_data table for a given table name
-        with open(path, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            self.fieldnames = reader.fieldnames
-            self.rows = [row for row in reader]
-
-    def get_wkt_by_centroid(self, lat, lng):
-        #Given a centroid, read thru the rows and pull out the 'WKT' value that  matches it.
+        #Open a specified .csv and read its header. The rows are streamed later by iter_rows, so the file is never fully buffered.
+        #Only the header is read here, so a bad CSV is reported before the .hyper file is copied.
         #The CSV must have a field called WKT and Latitude and Longitude
-        if len(self.rows) < 1:
-            return ''
-
-        for row in self.rows:
-            if(Decimal(lat) == Decimal(row['Latitude']) and Decimal(lng) == Decimal(row['Longitude'])):
-                return row['WKT']
+        with open(path, newline='') as csvfile:
+            self.fieldnames = next(csv.reader(csvfile), [])
+        missing = [name for name in ('Latitude', 'Longitude', 'WKT') if name not in self.fieldnames]
+        if missing:
+            raise ValueError(f"The header of {path} is missing the required column(s): {', '.join(missing)}")
+        self.path = path
+        self._idx_lat = self.fieldnames.index('Latitude')
+        self._idx_lng = self.fieldnames.index('Longitude')
+        self._idx_wkt = self.fieldnames.index('WKT')
+
+    def iter_rows(self):
+        #Yield (latitude, longitude, wkt) tuples, reading one row of the CSV at a time.
+        #Blank lines are skipped, as csv.DictReader did.
+        if self.path is None:
+            return
+        row_length = max(self._idx_lat, self._idx_lng, self._idx_wkt) + 1
+        with open(self.path, newline='') as csvfile:
+            reader = csv.reader(csvfile)
+            next(reader, None)
+            for row in reader:
+                if not row:
+                    continue
+                if len(row) < row_length:
+                    raise ValueError(f"Line {reader.line_num} of {self.path} has {len(row)} fields,"
+                                     f" expected at least {row_length}")
+                yield row[self._idx_lat], row[self._idx_lng], row[self._idx_wkt]
 
 
 class AppendWKTColumns:
-    """ Command to adjust vertex order of all polygons in a .hyper file """
+    """ Command to add WKT polygon columns to a geographic role in a .hyper file """
 
     Description = "Copies tables from a .hyper file to a new file while adding WKT polygon columns to certain tables"
     """ Description of the command """
@@ -130,6 +191,10 @@ class AppendWKTColumns:
                                 required=True, help="Name of the geographic role")
         arg_parser.add_argument("-id", "--id_field", type=str,
                                 required=True, help="Name of the unique ID field")
+        arg_parser.add_argument("-g", "--geography", action="store_true",
+                                help="Store the polygons in a GEOGRAPHY column instead of as WKT text. The WKT rings"
+                                     " must use interior-left vertex order, otherwise each polygon is stored as"
+                                     " its complement")
 
     def run(self, args):
         """ Runs the command
@@ -146,36 +211,115 @@ class AppendWKTColumns:
         
         # if the output file already exists, delete
         if os.path.exists(output_file):
-            if os.name == "nt": # deal with Windows
+            os.remove(output_file)
+
+        # Copies the input file in the background while the Hyper process starts up
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                copy_future = executor.submit(copy_file, input_file, output_file)
+
+                # Starts the Hyper Process with telemetry enabled to send data to Tableau.
+                # To opt out, simply set telemetry=Telemetry.DO_NOT_SEND_USAGE_DATA_TO_TABLEAU.
+                with HyperProcess(telemetry=Telemetry.SEND_USAGE_DATA_TO_TABLEAU) as hyper:
+                    copy_future.result()
+                    self._append_wkt(hyper, output_file, role_name, csv_query, args.geography)
+        except BaseException:
+            # e.g. a malformed CSV row; don't leave a half-finished output file behind
+            if os.path.exists(output_file):
                 os.remove(output_file)
-            else:
-                subprocess.call(["rm", "-rf", output_file]) 
-        shutil.copyfile(input_file, output_file)
-
-        # Starts the Hyper Process with telemetry enabled to send data to Tableau.
-        # To opt out, simply set telemetry=Telemetry.DO_NOT_SEND_USAGE_DATA_TO_TABLEAU.
-        with HyperProcess(telemetry=Telemetry.SEND_USAGE_DATA_TO_TABLEAU) as hyper:
-            with Connection(endpoint=hyper.endpoint,
-                            database=output_file) as connection:
-                table_name = TableName("public", "LocalData" + role_name)  #TODO: Make this dynamic based on an input parameter.
-                geo_name = Name('Geometry')
-                map_code_name = Name('MapCode')
-                latitude_name = Name('Latitude')
-                longitude_name = Name('Longitude')
-
-                connection.execute_query(f"ALTER TABLE {table_name} ADD COLUMN {geo_name} TEXT,"
-                                         f" ADD COLUMN {map_code_name} INTEGER").close()
-                for mrow in csv_query.rows:
-                    lat = mrow['Latitude']
-                    lng = mrow['Longitude']
-                    wkt = mrow['WKT']
-                    with connection.execute_query(f"UPDATE {table_name}" +
-                                                  f" SET {geo_name}={escape_string_literal(wkt)}, {map_code_name}=0" +
-                                                  f" WHERE {latitude_name}={lat}"
-                                                  f" AND {longitude_name}={lng}") as result:
-                        print(f"{result.affected_row_count} rows changed")
+            raise
         print('done')
 
+    @staticmethod
+    def _append_wkt(hyper, output_file, role_name, csv_query, geography):
+        """ Adds the WKT polygons of the CSV to the geographic role table of a .hyper file
+        :param hyper: The running HyperProcess
+        :param output_file: Path to the .hyper file to modify
+        :param role_name: Name of the geographic role
+        :param csv_query: CsvQueryClass opened on the WKT .csv file
+        :param geography: Whether to store the polygons as GEOGRAPHY, parsed once by Hyper, rather than as TEXT
+        """
+        with Connection(endpoint=hyper.endpoint,
+                        database=output_file) as connection:
+            table_name = TableName("public", "LocalData" + role_name)
+            new_table_name = TableName("public", "LocalData" + role_name + "_new")
+            geo_name = Name('Geometry')
+            map_code_name = Name('MapCode')
+            latitude_name = Name('Latitude')
+            longitude_name = Name('Longitude')
+            row_number_name = Name('RowNumber')
+            geo_type = SqlType.geography() if geography else SqlType.text()
+
+            # Runs all statements in one transaction so the changes are committed once,
+            # and the role table is left unmodified if anything fails
+            connection.execute_query("BEGIN TRANSACTION").close()
+            try:
+                # Stage all WKT rows in a temporary table so the geometry can be joined
+                # in a single set-oriented statement instead of one statement per CSV row.
+                # The CSV row number is kept so duplicate centroids can be resolved in Hyper.
+                stage_definition = TableDefinition(table_name=TableName("wkt_stage"), columns=[
+                    TableDefinition.Column(row_number_name, SqlType.int()),
+                    TableDefinition.Column(latitude_name, SqlType.double()),
+                    TableDefinition.Column(longitude_name, SqlType.double()),
+                    TableDefinition.Column(geo_name, SqlType.text())
+                ], persistence=Persistence.TEMPORARY)
+                stage_name = stage_definition.table_name
+                connection.catalog.create_table(stage_definition)
+                with Inserter(connection, stage_definition) as inserter:
+                    for row_number, (lat, lng, wkt) in enumerate(csv_query.iter_rows()):
+                        inserter.add_row([row_number, float(lat), float(lng), wkt])
+                    inserter.execute()
+
+                duplicates = connection.execute_list_query(f"SELECT {latitude_name}, {longitude_name}"
+                                                           f" FROM {stage_name}"
+                                                           f" GROUP BY {latitude_name}, {longitude_name}"
+                                                           f" HAVING COUNT(DISTINCT {geo_name}) > 1")
+                for lat, lng in duplicates:
+                    print(f"Warning: duplicate centroid ({lat}, {lng}) has a different WKT; using the later row")
+
+                # One row per centroid; the last CSV row wins, as it did when one UPDATE was issued
+                # per CSV row in file order
+                unique_stage = (f"(SELECT {latitude_name}, {longitude_name}, {geo_name} FROM"
+                                f" (SELECT {latitude_name}, {longitude_name}, {geo_name},"
+                                f" ROW_NUMBER() OVER (PARTITION BY {latitude_name}, {longitude_name}"
+                                f" ORDER BY {row_number_name} DESC) AS rn FROM {stage_name}) ranked"
+                                f" WHERE rn = 1)")
+
+                # Rebuilds the table with the two new columns in one sequential scan and write, rather than
+                # adding the columns and rewriting every matched row with an UPDATE. The new table is created
+                # from the catalog definition of the original, so column nullability and collations are kept.
+                # Hyper has no secondary indexes; the join against the stage table is planned as a hash join.
+                # The deduplicated stage holds one row per centroid, so the LEFT JOIN keeps exactly one
+                # output row per input row.
+                table_definition = connection.catalog.get_table_definition(name=table_name)
+                connection.catalog.create_table(TableDefinition(
+                    table_name=new_table_name,
+                    columns=list(table_definition.columns) + [
+                        TableDefinition.Column(geo_name, geo_type),
+                        TableDefinition.Column(map_code_name, SqlType.int())
+                    ]))
+                connection.execute_query(f"INSERT INTO {new_table_name}"
+                                         f" SELECT t.*, CAST(s.{geo_name} AS {geo_type}),"
+                                         f" CASE WHEN s.{geo_name} IS NULL THEN NULL ELSE 0 END"
+                                         f" FROM {table_name} t LEFT JOIN {unique_stage} s"
+                                         f" ON t.{latitude_name}=s.{latitude_name}"
+                                         f" AND t.{longitude_name}=s.{longitude_name}").close()
+                # MapCode is set only on rows that matched a CSV centroid; counting the single INTEGER column is cheap
+                rows_changed = connection.execute_scalar_query(
+                    query=f"SELECT COUNT({map_code_name}) FROM {new_table_name}")
+                print(f"{rows_changed} rows changed")
+                connection.execute_query(f"DROP TABLE {table_name}").close()
+                connection.execute_query(f"ALTER TABLE {new_table_name} RENAME TO {table_name.name}").close()
+                connection.execute_query(f"DROP TABLE {stage_name}").close()
+            except BaseException:
+                try:
+                    connection.execute_query("ROLLBACK").close()
+                except Exception:
+                    # e.g. the connection is already broken; the original error is the one to report
+                    pass
+                raise
+            connection.execute_query("COMMIT").close()
+
 
 def main(argv):
     command_map = {}